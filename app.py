@@ -1,37 +1,90 @@
 # -*- coding: utf-8 -*-
 from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
 import akshare as ak
 import yfinance as yf
 import logging
+import os
+import functools
+import hashlib
+import re
 import pandas as pd
-import numpy as np
 import schedule
 import time
 import threading
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone, time as dtime
 import pytz
-import json
+from cachetools import TTLCache
+import orjson
 
 # --- 初始化 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 app = Flask(__name__)
-app.json.ensure_ascii = False
 
-# --- 全局变量与锁 ---
+class OrjsonProvider(JSONProvider):
+    # orjson 在 C 层完成序列化，原生支持 numpy 标量/数组与 date 类型，且始终输出 UTF-8 (无需 ensure_ascii)
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    @staticmethod
+    def default(o):
+        if hasattr(o, 'isoformat'): return o.isoformat()
+        if hasattr(o, 'tolist'): return o.tolist()
+        raise TypeError(f"无法序列化类型 {type(o).__name__}")
+    def dumps(self, obj, **kwargs): return orjson.dumps(obj, default=self.default, option=self.option).decode('utf-8')
+    def loads(self, s, **kwargs): return orjson.loads(s)
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.option), mimetype='application/json')
+
+app.json = OrjsonProvider(app)
+
+# --- 全局变量 ---
+# 无锁约定：读者只获取一次字典引用；单个键的写入在 GIL 下是原子的；清空缓存时整体换入新字典
 quote_cache = {}
 code_name_map = {}
-cache_lock = threading.Lock()
 CODE_MAP_FILE = 'code_name_map.json'
+_NON_DIGITS = re.compile(r'\D')
+_DATE_RE = re.compile(r'[0-9]{8}')  # YYYYMMDD
+ETF_PREFIXES = frozenset({'51', '56', '58', '15'})  # 代码前两位落在其中的视为 ETF
+
+# --- 交易时段常量 (避免每次调用都重新解析/构造) ---
+TZ_SH = pytz.timezone('Asia/Shanghai')
+TRADE_AM_START, TRADE_AM_END = dtime(9, 25), dtime(11, 31)
+TRADE_PM_START, TRADE_PM_END = dtime(12, 55), dtime(15, 1)
+# 上海固定为 UTC+8 且无夏令时，交易时段对应 UTC 01:25-07:01，且该窗口内 UTC 与上海的星期相同
+UTC_WINDOW_START, UTC_WINDOW_END = dtime(1, 25), dtime(7, 1)
+_trade_cache = (0, False)  # (单调时钟整秒, 是否交易时段)
+
+# --- 雅虎财经短时缓存 (交易时段内合并并发请求，同一代码同一时刻只向上游发起一次请求) ---
+YAHOO_INFO_TTL = 10
+yahoo_info_cache = TTLCache(maxsize=1024, ttl=YAHOO_INFO_TTL)
+# 正在进行中的上游请求 {yahoo_symbol: Future}，请求结束即移除，规模只取决于并发中的请求数
+yahoo_inflight = {}
+yahoo_cache_lock = threading.Lock()  # TTLCache 本身不是线程安全的
+# 雅虎财经请求是阻塞的 I/O，跨请求复用同一个线程池并行拉取
+quote_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='yahoo')
+
+# --- 历史行情缓存 ---
+# 注意：接口使用前复权 (adjust="qfq")，每逢除权除息日历史价格都会被整体重算，已收盘区间的数据并非不变；
+# 因此已收盘区间也只缓存 1 小时，接受除权当天最多 1 小时与新查询结果不一致
+HISTORY_TTL_CLOSED = 3600       # 结束日期早于今天
+HISTORY_TTL_OPEN = 300          # 区间包含今天，当日数据仍可能更新
+# 缓存条目是完整的序列化响应体 (多年日线约百 KB)，按字节数而非条目数限制每个 worker 的内存占用
+HISTORY_CACHE_BYTES_CLOSED = 32 * 1024 * 1024
+HISTORY_CACHE_BYTES_OPEN = 8 * 1024 * 1024
+history_cache_closed = TTLCache(maxsize=HISTORY_CACHE_BYTES_CLOSED, ttl=HISTORY_TTL_CLOSED, getsizeof=lambda entry: len(entry[0]))
+history_cache_open = TTLCache(maxsize=HISTORY_CACHE_BYTES_OPEN, ttl=HISTORY_TTL_OPEN, getsizeof=lambda entry: len(entry[0]))
+history_cache_lock = threading.Lock()
 
 # --- 从本地JSON文件加载名称映射 ---
 def load_code_name_map_from_file():
     global code_name_map
     try:
         app.logger.info(f"正在从文件 '{CODE_MAP_FILE}' 加载代码-名称映射表...")
-        with open(CODE_MAP_FILE, 'r', encoding='utf-8') as f:
-            temp_map = json.load(f)
-        with cache_lock:
-            code_name_map = temp_map
+        with open(CODE_MAP_FILE, 'rb') as f:
+            temp_map = orjson.loads(f.read())
+        # 整体重新绑定即可 (GIL 下为原子操作)，读者只持有引用，任何地方都不得原地修改该字典
+        code_name_map = temp_map
         app.logger.info(f"代码-名称映射表加载完成，总计 {len(code_name_map)} 条记录。")
     except FileNotFoundError:
         app.logger.error(f"严重错误：映射文件 '{CODE_MAP_FILE}' 未找到！")
@@ -40,21 +93,52 @@ def load_code_name_map_from_file():
 
 # (其他辅助函数保持不变)
 def is_trade_time():
-    tz = pytz.timezone('Asia/Shanghai'); now = datetime.now(tz)
-    if 1 <= now.isoweekday() <= 5:
-        now_time = now.time()
-        if (datetime.strptime("09:25", "%H:%M").time() <= now_time <= datetime.strptime("15:01", "%H:%M").time()) and \
-           not (datetime.strptime("11:31", "%H:%M").time() < now_time < datetime.strptime("12:55", "%H:%M").time()):
-            return True
-    return False
+    # 结果只在分钟边界变化，同一秒内的重复调用直接复用 (元组整体替换在 GIL 下是原子的，不需要锁)
+    global _trade_cache
+    now_sec = int(time.monotonic()); cached_sec, cached_val = _trade_cache
+    if cached_sec == now_sec: return cached_val
+    val = _compute_trade_time(); _trade_cache = (now_sec, val)
+    return val
+
+def _compute_trade_time():
+    # 先用 UTC 时间快速排除周末与非交易窗口，只有可能处于交易时段时才做时区转换
+    utc_now = datetime.now(timezone.utc)
+    if utc_now.weekday() >= 5 or not (UTC_WINDOW_START <= utc_now.time() <= UTC_WINDOW_END): return False
+    # 复用同一时刻换算上海时间；UTC 预检查已保证是工作日
+    now_time = utc_now.astimezone(TZ_SH).time()
+    return (TRADE_AM_START <= now_time <= TRADE_PM_END) and not (TRADE_AM_END < now_time < TRADE_PM_START)
 
+def extract_code(symbol):
+    # 一次 C 层扫描去掉所有非数字字符，等价于 ''.join(filter(str.isdigit, symbol))
+    return _NON_DIGITS.sub('', symbol)
+
+@functools.lru_cache(maxsize=4096)
 def convert_to_yahoo_symbol(symbol):
-    code_only = ''.join(filter(str.isdigit, symbol))
+    code_only = extract_code(symbol)
     if not code_only: return None
     if symbol.lower().startswith('sh') or code_only.startswith(('6', '5')): return f"{code_only}.SS"
     if symbol.lower().startswith('sz') or code_only.startswith(('0', '3', '1')): return f"{code_only}.SZ"
     return None
 
+def fetch_yahoo_info(yahoo_symbol):
+    with yahoo_cache_lock:
+        info = yahoo_info_cache.get(yahoo_symbol)
+        if info is not None: return info
+        inflight = yahoo_inflight.get(yahoo_symbol); is_leader = inflight is None
+        if is_leader: inflight = yahoo_inflight[yahoo_symbol] = Future()
+    # 同一代码已有线程在请求：直接等待其结果 (包括异常)，不同代码之间互不阻塞
+    if not is_leader: return inflight.result()
+    try:
+        app.logger.info(f"[{yahoo_symbol}] 实时请求雅虎财经...")
+        info = yf.Ticker(yahoo_symbol).info
+        with yahoo_cache_lock: yahoo_info_cache[yahoo_symbol] = info
+        inflight.set_result(info)
+        return info
+    except Exception as e:
+        inflight.set_exception(e); raise
+    finally:
+        with yahoo_cache_lock: yahoo_inflight.pop(yahoo_symbol, None)
+
 def map_yahoo_to_app_format(info, original_symbol):
     if not info or 'regularMarketPrice' not in info or info['regularMarketPrice'] is None:
          raise ValueError(f"雅虎财经未返回 {original_symbol} 的有效数据")
@@ -65,12 +149,30 @@ def map_yahoo_to_app_format(info, original_symbol):
 
 def clear_quote_cache():
     global quote_cache
-    with cache_lock:
-        if quote_cache: app.logger.info(f"清空旧的行情缓存，共 {len(quote_cache)} 条数据。"); quote_cache = {}
+    old_cache, quote_cache = quote_cache, {}
+    if old_cache: app.logger.info(f"清空旧的行情缓存，共 {len(old_cache)} 条数据。")
 
 def run_schedule():
     app.logger.info("后台调度线程已启动。"); schedule.every().day.at("09:25", "Asia/Shanghai").do(clear_quote_cache)
-    while True: schedule.run_pending(); time.sleep(1)
+    while True:
+        # 休眠到下一个任务到期，而不是每秒轮询；最长 60 秒醒来一次以应对系统时钟跳变
+        idle = schedule.idle_seconds()
+        if idle is None: idle = 60
+        if idle > 0: time.sleep(min(idle, 60))
+        schedule.run_pending()
+
+def fetch_quote(symbol, yahoo_symbol, name_map):
+    info_data = fetch_yahoo_info(yahoo_symbol)
+    formatted_data = map_yahoo_to_app_format(info_data, symbol)
+    
+    # --- 【核心修复】构建正确的查询键(key)来获取中文名 ---
+    code_only = extract_code(symbol)
+    prefix = 'sh' if code_only.startswith(('6', '5')) else 'sz'
+    full_symbol_for_lookup = f"{prefix}{code_only}"
+    
+    # 使用构建好的 key 进行查询
+    formatted_data['名称'] = name_map.get(full_symbol_for_lookup, formatted_data['名称'])
+    return formatted_data
 
 # --- 实时行情接口 ---
 @app.route('/api/quotes', methods=['GET'])
@@ -79,55 +181,100 @@ def get_quotes():
     if not symbols_str: return jsonify({"error": "请提供'symbols'查询参数"}), 400
     symbol_list = [s.strip() for s in symbols_str.split(',')]
     results = {}; trade_time_now = is_trade_time()
+    # 只读取一次全局引用：调度线程只会整体替换这些字典，本次请求内始终看到同一个版本
+    current_quote_cache, current_name_map = quote_cache, code_name_map
+    futures = {}
     for symbol in symbol_list:
         try:
-            if not trade_time_now and symbol in quote_cache:
-                app.logger.info(f"[{symbol}] 命中收盘价缓存。"); results[symbol] = {"status": "success", "data": quote_cache[symbol]}; continue
+            cached_data = None if trade_time_now else current_quote_cache.get(symbol)
+            if cached_data is not None:
+                app.logger.info(f"[{symbol}] 命中收盘价缓存。"); results[symbol] = {"status": "success", "data": cached_data}; continue
             
             yahoo_symbol = convert_to_yahoo_symbol(symbol)
             if not yahoo_symbol: raise ValueError("无法识别的股票/ETF代码")
             
-            app.logger.info(f"[{symbol} -> {yahoo_symbol}] 实时请求雅虎财经...")
-            ticker = yf.Ticker(yahoo_symbol)
-            info_data = ticker.info
-            formatted_data = map_yahoo_to_app_format(info_data, symbol)
-            
-            # --- 【核心修复】构建正确的查询键(key)来获取中文名 ---
-            code_only = ''.join(filter(str.isdigit, symbol))
-            prefix = 'sh' if code_only.startswith(('6', '5')) else 'sz'
-            full_symbol_for_lookup = f"{prefix}{code_only}"
-            
-            # 使用构建好的 key 进行查询
-            formatted_data['名称'] = code_name_map.get(full_symbol_for_lookup, formatted_data['名称'])
-
+            # 网络请求交给线程池并行执行，结果在下方按原顺序收集
+            results[symbol] = None
+            if symbol not in futures: futures[symbol] = quote_executor.submit(fetch_quote, symbol, yahoo_symbol, current_name_map)
+        except Exception as e:
+            app.logger.error(f"处理代码 {symbol} 时发生错误: {e}"); results[symbol] = {"status": "error", "message": str(e)}
+    local_writes = {}
+    for symbol, future in futures.items():
+        try:
+            formatted_data = future.result()
             results[symbol] = {"status": "success", "data": formatted_data}
-            if not trade_time_now:
-                with cache_lock: quote_cache[symbol] = formatted_data
+            local_writes[symbol] = formatted_data
         except Exception as e:
             app.logger.error(f"处理代码 {symbol} 时发生错误: {e}"); results[symbol] = {"status": "error", "message": str(e)}
+    # 收盘后的结果先在本地累积，最后一次性写入缓存
+    if not trade_time_now and local_writes: current_quote_cache.update(local_writes)
     return jsonify(results)
 
-# --- 历史行情接口 (保持不变) ---
+# 返回 (序列化后的 columns/data 字节串, etag)，按 (代码, 起始日期, 结束日期) 缓存；
+# 只缓存字节串：既省去每次命中的重复序列化，也远小于装箱后的 Python 列表
+def fetch_history(code_only, start_date, end_date):
+    today = datetime.now(TZ_SH).strftime('%Y%m%d')
+    cache = history_cache_closed if end_date < today else history_cache_open
+    key = (code_only, start_date, end_date)
+    with history_cache_lock: entry = cache.get(key)
+    if entry is not None: return entry
+    if code_only[:2] in ETF_PREFIXES: history_df = ak.fund_etf_hist_em(symbol=code_only, period="daily", start_date=start_date, end_date=end_date, adjust="qfq")
+    else: history_df = ak.stock_zh_a_hist(symbol=code_only, period="daily", start_date=start_date, end_date=end_date, adjust="qfq")
+    if history_df is None or history_df.empty: raise ValueError(f"Akshare 未返回有效数据。")
+    # 无需再把 NaN 替换为 None：orjson 序列化时会直接输出 null
+    # 按列返回 (列名只出现一次)，避免逐行字典重复携带所有列名
+    columns = list(history_df.columns)
+    payload = {"columns": columns, "data": {c: history_df[c].tolist() for c in columns}}
+    body = orjson.dumps(payload, default=OrjsonProvider.default, option=OrjsonProvider.option)
+    entry = (body, hashlib.blake2b(body).hexdigest()[:16])
+    # 超过整个缓存容量的单个响应体不缓存 (TTLCache 会直接抛出 ValueError)
+    if len(body) <= cache.maxsize:
+        with history_cache_lock: cache[key] = entry
+    return entry
+
+# --- 历史行情接口 ---
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    symbol = request.args.get('symbol'); start_date, end_date = request.args.get('start_date', '20200101'), request.args.get('end_date', datetime.now().strftime('%Y%m%d'))
+    symbol = request.args.get('symbol'); start_date, end_date = request.args.get('start_date', '20200101'), request.args.get('end_date', datetime.now(TZ_SH).strftime('%Y%m%d'))
     if not symbol: return jsonify({"status": "error", "message": "必须提供 'symbol' 参数。"}), 400
+    # 日期参数同时作为缓存键，必须先校验格式，避免任意字符串占满缓存并触发上游请求
+    if not (_DATE_RE.fullmatch(start_date) and _DATE_RE.fullmatch(end_date)):
+        return jsonify({"status": "error", "message": "'start_date' 与 'end_date' 必须为 YYYYMMDD 格式。"}), 400
     try:
-        code_only = ''.join(filter(str.isdigit, symbol)); history_df = None
-        if code_only.startswith(('51', '56', '58', '15')): history_df = ak.fund_etf_hist_em(symbol=code_only, period="daily", start_date=start_date, end_date=end_date, adjust="qfq")
-        else: history_df = ak.stock_zh_a_hist(symbol=code_only, period="daily", start_date=start_date, end_date=end_date, adjust="qfq")
-        if history_df is None or history_df.empty: raise ValueError(f"Akshare 未返回有效数据。")
-        history_df.replace({np.nan: None}, inplace=True); history_df['日期'] = history_df['日期'].astype(str)
-        return jsonify({"status": "success", "symbol": symbol, "data": history_df.to_dict(orient='records')})
+        body, etag = fetch_history(extract_code(symbol), start_date, end_date)
+        # If-None-Match 按 RFC 7232 使用弱比较 (代理压缩后可能把 ETag 改为 W/"...")
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304); response.set_etag(etag); return response
+        # 在缓存的 {"columns":...,"data":...} 字节串前拼上 status/symbol 字段，不再重新序列化整段数据
+        response = app.response_class(b'{"status":"success","symbol":' + orjson.dumps(symbol) + b',' + body[1:], mimetype='application/json')
+        response.set_etag(etag)
+        return response
     except Exception as e:
         app.logger.error(f"获取历史行情 {symbol} 时发生错误: {e}"); return jsonify({"status": "error", "message": str(e)}), 500
 
 # --- 主程序入口 ---
+# 线程不会随 fork 复制，按进程号记录调度线程是否已在当前进程启动
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def start_scheduler():
+    global _scheduler_pid
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid(): return
+        _scheduler_pid = os.getpid()
+        scheduler_thread = threading.Thread(target=run_schedule); scheduler_thread.daemon = True; scheduler_thread.start()
+
+@app.before_request
+def ensure_scheduler():
+    # 兜底：未经 gunicorn.conf.py 的 post_fork 钩子启动 (换用其他配置或其他 WSGI 服务器) 时，
+    # 在当前进程处理第一个请求时启动调度线程，保证 09:25 的缓存清空不会缺失
+    if _scheduler_pid != os.getpid(): start_scheduler()
+
 if __name__ == '__main__':
-    app.logger.info("服务器以开发模式启动，开始初始化..."); load_code_name_map_from_file()
-    scheduler_thread = threading.Thread(target=run_schedule); scheduler_thread.daemon = True; scheduler_thread.start()
+    app.logger.info("服务器以开发模式启动，开始初始化..."); load_code_name_map_from_file(); start_scheduler()
     app.run(host='0.0.0.0', port=5000, debug=False)
 elif __name__ != '__main__':
+    # 配合 gunicorn.conf.py 的 preload_app：映射表只在主进程加载一次，fork 后由各 worker 写时复制共享；
+    # 线程不会随 fork 一起复制，调度线程由 post_fork 钩子在每个 worker 内启动，未配置钩子时由 ensure_scheduler 在首个请求时启动
     gunicorn_logger = logging.getLogger('gunicorn.error'); app.logger.handlers = gunicorn_logger.handlers; app.logger.setLevel(gunicorn_logger.level)
     app.logger.info("服务器由Gunicorn启动，开始初始化..."); load_code_name_map_from_file()
-    scheduler_thread = threading.Thread(target=run_schedule); scheduler_thread.daemon = True; scheduler_thread.start()
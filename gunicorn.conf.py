@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Gunicorn 配置 (在项目根目录执行 gunicorn app:app 时会被自动加载)
+
+# 在主进程中导入应用：名称映射表只加载一次，fork 出的 worker 以写时复制方式共享
+preload_app = True
+
+# 行情请求以网络 I/O 为主，使用线程型 worker 让单个进程可并发处理多个请求
+worker_class = 'gthread'
+threads = 8
+
+def post_fork(server, worker):
+    # 行情缓存是进程内的，每个 worker 需要自己的调度线程按时清空缓存
+    from app import start_scheduler
+    start_scheduler()